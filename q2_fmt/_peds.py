@@ -15,9 +15,18 @@ import os
 import pkg_resources
 import jinja2
 import json
+from scipy import sparse
 
 from q2_fmt._util import json_replace
 
+# Feature tables with fewer non-zero entries than this fraction are
+# intersected as CSR matrices rather than dense boolean arrays
+_SPARSE_DENSITY = 0.1
+# Number of set bits in every possible byte, for NumPy < 2.0 which lacks
+# np.bitwise_count
+_BYTE_BIT_COUNTS = np.array([bin(byte).count('1') for byte in range(256)],
+                            dtype=np.uint8)
+
 
 def peds(ctx, table, metadata, peds_metric, time_column, reference_column,
          subject_column, filter_missing_references=False,
@@ -108,7 +117,8 @@ def sample_peds(table: pd.DataFrame, metadata: qiime2.Metadata,
     metadata = metadata.filter_ids(ids_to_keep=ids_with_data)
     column_properties = metadata.columns
     # TODO: Make incomplete samples possible move this to heatmap
-    metadata = metadata.to_dataframe()
+    metadata = _subset_metadata(metadata, time_column, reference_column,
+                                subject_column)
     num_timepoints = _check_for_time_column(metadata, time_column)
     _check_column_type(column_properties, "time",
                        time_column, "numeric")
@@ -135,13 +145,11 @@ def sample_peds(table: pd.DataFrame, metadata: qiime2.Metadata,
                                           drop_incomplete_subjects, metadata,
                                           subject_column, used_references)
 
-    peds_df = pd.DataFrame(columns=['id', 'measure',
-                                    'transfered_donor_features',
-                                    'total_donor_features', 'donor', 'subject',
-                                    'group'])
-    peds_df = _compute_peds(peds_df=peds_df, peds_type="Sample",
-                            peds_time=np.nan, reference_series=used_references,
-                            table=table, metadata=metadata,
+    peds_df = _compute_peds(peds_type="Sample",
+                            reference_series=used_references,
+                            table_bool=_presence_matrix(table),
+                            table_index=table.index,
+                            table_columns=table.columns, metadata=metadata,
                             time_column=time_column,
                             subject_column=subject_column,
                             reference_column=reference_column)
@@ -154,7 +162,8 @@ def feature_peds(table: pd.DataFrame, metadata: qiime2.Metadata,
     ids_with_data = table.index
     metadata = metadata.filter_ids(ids_to_keep=ids_with_data)
     column_properties = metadata.columns
-    metadata = metadata.to_dataframe()
+    metadata = _subset_metadata(metadata, time_column, reference_column,
+                                subject_column)
 
     _ = _check_for_time_column(metadata, time_column)
     _check_column_type(column_properties, "time",
@@ -169,56 +178,68 @@ def feature_peds(table: pd.DataFrame, metadata: qiime2.Metadata,
     _ = _check_subject_column(metadata, subject_column)
     _check_column_type(column_properties, "subject",
                        subject_column, "categorical")
-    peds_df = pd.DataFrame(columns=['id', 'measure', 'recipients with feature',
-                                    'all possible recipients with feature',
-                                    'group', 'subject'])
-    for time, time_metadata in metadata.groupby(time_column):
-        peds_df = _compute_peds(peds_df=peds_df, peds_type="Feature",
-                                peds_time=time,
-                                reference_series=used_references, table=table,
-                                metadata=time_metadata,
-                                time_column=time_column,
-                                subject_column=subject_column,
-                                reference_column=reference_column)
+    peds_df = _compute_peds(peds_type="Feature",
+                            reference_series=used_references,
+                            table_bool=_presence_matrix(table),
+                            table_index=table.index,
+                            table_columns=table.columns, metadata=metadata,
+                            time_column=time_column,
+                            subject_column=subject_column,
+                            reference_column=reference_column)
     return peds_df
 
 
-def _compute_peds(peds_df: pd.Series, peds_type: str, peds_time: int,
-                  reference_series: pd.Series, table: pd.Series,
+def _compute_peds(peds_type: str,
+                  reference_series: pd.Series, table_bool,
+                  table_index: pd.Index, table_columns: pd.Index,
                   metadata: qiime2.Metadata, time_column: str,
                   subject_column: str,
                   reference_column: str) -> (pd.DataFrame):
-    table = table > 0
-    reference_overlap = reference_series.isin(table.index)
-    try:
-        assert all(reference_overlap)
-    except AssertionError as e:
-        missing_ref = reference_series[~reference_overlap].unique()
+    # a single hash lookup of the references against the table is reused
+    # both for the overlap check and for selecting the donor rows
+    reference_positions = table_index.get_indexer(reference_series)
+    reference_overlap = reference_positions != -1
+    if not reference_overlap.all():
+        missing_ref = \
+            pd.unique(reference_series.to_numpy()[~reference_overlap])
         raise AssertionError('Reference IDs: %s provided were not found in'
                              ' the feature table. Please confirm that all'
                              ' values in reference column are present in the'
-                             ' feature table' % missing_ref) from e
-    donor_df = table[table.index.isin(reference_series)]
-    recip_df = _create_recipient_table(reference_series, metadata, table)
-
-    donormask = _create_masking(time_metadata=metadata, donor_df=donor_df,
-                                recip_df=recip_df,
-                                reference_column=reference_column)
-    maskedrecip = donormask & recip_df
+                             ' feature table' % missing_ref)
+    donor_positions = np.unique(reference_positions)
+    donor_matrix = table_bool[donor_positions]
+    recip_positions = _get_recipient_rows(reference_series, metadata,
+                                          table_index)
+    recip_index = table_index[recip_positions]
+    recipmask = table_bool[recip_positions]
+
+    # a single row lookup provides every per-recipient metadata value
+    recip_metadata = metadata.loc[recip_index, [reference_column,
+                                                subject_column,
+                                                time_column]]
+    donor_rows = table_index[donor_positions].get_indexer(
+        recip_metadata[reference_column])
     if peds_type == "Sample":
-        num_sum = np.sum(maskedrecip, axis=1)
-        donor_sum = np.sum(donormask, axis=1)
-        for count, sample in enumerate(recip_df.index):
-            sample_row = metadata.loc[sample]
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                peds = num_sum[count] / donor_sum[count]
-
-            peds_df.loc[len(peds_df)] = [sample, peds, num_sum[count],
-                                         donor_sum[count],
-                                         sample_row[reference_column],
-                                         sample_row[subject_column],
-                                         sample_row[time_column]]
+        donor_sum = _sum_mask(donor_matrix, axis=1)[donor_rows]
+        # recipients whose donor has no features transfer nothing, so only
+        # the remaining recipients are intersected with their donor
+        active = np.flatnonzero(donor_sum > 0)
+        if active.size < donor_sum.size:
+            recipmask = recipmask[active]
+        num_sum = np.zeros_like(donor_sum)
+        num_sum[active] = _count_transferred(donor_matrix, donor_rows[active],
+                                             recipmask)
+        measure = np.full(num_sum.shape, np.nan)
+        np.divide(num_sum, donor_sum, out=measure, where=donor_sum > 0)
+        peds_df = pd.DataFrame({
+            'id': recip_index.to_numpy(dtype=object),
+            'measure': measure,
+            'transfered_donor_features': num_sum.astype(np.int64, copy=False),
+            'total_donor_features': donor_sum.astype(np.int64, copy=False),
+            'donor': recip_metadata[reference_column].to_numpy(dtype=object),
+            'subject': recip_metadata[subject_column].to_numpy(dtype=object),
+            'group': recip_metadata[time_column].to_numpy(dtype=np.float64)
+        })
         peds_df['id'].attrs.update({
             'title': reference_series.index.name,
             'description': 'Sample IDs'
@@ -249,15 +270,31 @@ def _compute_peds(peds_df: pd.Series, peds_type: str, peds_time: int,
         })
 
     elif peds_type == "Feature":
-        num_sum = np.sum(maskedrecip, axis=0)
-        donor_sum = np.sum(donormask, axis=0)
-        for count, feature in enumerate(recip_df.columns):
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                peds = num_sum[count] / donor_sum[count]
-            peds_df.loc[len(peds_df)] = [feature, peds, num_sum[count],
-                                         donor_sum[count], peds_time, feature]
-            peds_df = peds_df.dropna()
+        times, time_ids = np.unique(recip_metadata[time_column].to_numpy(),
+                                    return_inverse=True)
+        num_sum, donor_sum = _count_feature_peds(donor_matrix, donor_rows,
+                                                 recipmask, time_ids,
+                                                 len(times))
+        num_sum = num_sum.ravel()
+        donor_sum = donor_sum.ravel()
+        # features absent from every donor at a timepoint have no PEDS
+        # value, so they are dropped before the frame is built
+        keep = donor_sum > 0
+        num_sum = num_sum[keep]
+        donor_sum = donor_sum[keep]
+        measure = num_sum / donor_sum
+        features = np.tile(table_columns.to_numpy(dtype=object),
+                           len(times))[keep]
+        peds_df = pd.DataFrame({
+            'id': features,
+            'measure': measure,
+            'recipients with feature': num_sum.astype(np.int64, copy=False),
+            'all possible recipients with feature':
+                donor_sum.astype(np.int64, copy=False),
+            'group': np.repeat(times.astype(np.float64, copy=False),
+                               len(table_columns))[keep],
+            'subject': features
+        })
 
         peds_df['id'].attrs.update({
             'title': "Feature ID",
@@ -324,6 +361,23 @@ def _rename_features(level_delimiter, data: pd.DataFrame):
 
 
 # Filtering methods
+def _subset_metadata(metadata, *columns):
+    # Only the columns PEDS uses are converted to pandas. Missing columns
+    # are skipped here so the column checks can report them.
+    subset = {}
+    for column in columns:
+        if column not in metadata.columns:
+            continue
+        series = metadata.get_column(column).to_series()
+        # categorical IDs are stored as integer codes, so later grouping
+        # and matching against the table hash each distinct ID only once
+        if metadata.columns[column].type == 'categorical':
+            series = series.astype('category')
+        subset[column] = series
+    return pd.DataFrame(subset,
+                        index=pd.Index(metadata.ids, name=metadata.id_header))
+
+
 def _check_for_time_column(metadata, time_column):
     try:
         num_timepoints = metadata[time_column].dropna().unique().size
@@ -369,14 +423,19 @@ def _check_subject_column(metadata, subject_column):
 
 def _check_duplicate_subject_timepoint(subject_series, metadata,
                                        subject_column, time_column):
-    for subject in subject_series:
-        subject_df = metadata[metadata[subject_column] == subject]
-        if not subject_df[time_column].is_unique:
-            timepoint_list = subject_df[time_column].to_list()
-            raise ValueError('There is more than one occurrence of a subject'
-                             ' in a timepoint. All subjects must occur only'
-                             ' once per timepoint. Subject %s appears in '
-                             ' timepoints: %s' % (subject, timepoint_list))
+    duplicated = metadata.duplicated(subset=[subject_column, time_column],
+                                     keep=False)
+    duplicated_subjects = subject_series[duplicated].dropna().unique()
+    if duplicated_subjects.size:
+        # report the first subject (in metadata order) with a duplicate
+        subject_mask = subject_series.isin(duplicated_subjects)
+        subject = subject_series[subject_mask].iloc[0]
+        timepoint_list = \
+            metadata.loc[subject_series == subject, time_column].to_list()
+        raise ValueError('There is more than one occurrence of a subject'
+                         ' in a timepoint. All subjects must occur only'
+                         ' once per timepoint. Subject %s appears in '
+                         ' timepoints: %s' % (subject, timepoint_list))
 
 
 def _drop_incomplete_timepoints(metadata, time_column,
@@ -400,28 +459,36 @@ def _check_subjects_in_all_timepoints(subject_series, num_timepoints,
                                       drop_incomplete_subjects, metadata,
                                       subject_column, used_references):
 
-    subject_occurrence_series = (subject_series.value_counts())
-    if (subject_occurrence_series < num_timepoints).any():
-        if drop_incomplete_subjects:
-            subject_to_keep = (subject_occurrence_series[
-                                subject_occurrence_series ==
-                                num_timepoints].index)
-            metadata = metadata[metadata[subject_column].isin(subject_to_keep)]
-            used_references = used_references.filter(axis=0,
-                                                     items=metadata.index)
-        else:
-            incomplete_subjects = (subject_occurrence_series[
-                                    subject_occurrence_series
-                                    != num_timepoints].index).to_list()
-            raise ValueError('Missing timepoints for associated subjects.'
-                             ' Please make sure that all subjects have all'
-                             ' timepoints. You can drop these subjects by'
-                             ' using the drop_incomplete_subjects parameter or'
-                             ' drop any timepoints that have large numbers'
-                             ' of subjects missing by using the'
-                             ' drop_incomplete_timepoints parameter. The'
-                             ' incomplete subjects were %s'
-                             % incomplete_subjects)
+    # samples without a timepoint have no used reference and are not
+    # counted towards the timepoints of their subject
+    timed_subject_series = \
+        subject_series[subject_series.index.isin(used_references.index)]
+    subject_occurrence_series = timed_subject_series.value_counts(sort=False)
+    # categorical subjects also report filtered out subjects with no samples
+    subject_occurrence_series = \
+        subject_occurrence_series[subject_occurrence_series > 0]
+    subject_counts = subject_occurrence_series.to_numpy()
+    incomplete = subject_counts < num_timepoints
+    if not incomplete.any():
+        return metadata, used_references
+    if drop_incomplete_subjects:
+        subject_to_keep = \
+            subject_occurrence_series.index[subject_counts == num_timepoints]
+        metadata = metadata[metadata[subject_column].isin(subject_to_keep)]
+        used_references = used_references.filter(axis=0,
+                                                 items=metadata.index)
+    else:
+        incomplete_subjects = \
+            subject_occurrence_series.index[incomplete].to_list()
+        raise ValueError('Missing timepoints for associated subjects.'
+                         ' Please make sure that all subjects have all'
+                         ' timepoints. You can drop these subjects by'
+                         ' using the drop_incomplete_subjects parameter or'
+                         ' drop any timepoints that have large numbers'
+                         ' of subjects missing by using the'
+                         ' drop_incomplete_timepoints parameter. The'
+                         ' incomplete subjects were %s'
+                         % incomplete_subjects)
     return metadata, used_references
 
 
@@ -451,26 +518,93 @@ def _check_column_missing(metadata, column, column_param, e):
 
 
 # PEDS calculation methods
-def _create_recipient_table(reference_series, time_metadata, table_df):
+def _presence_matrix(table):
+    table_bool = table.to_numpy() > 0
+    if np.count_nonzero(table_bool) < _SPARSE_DENSITY * table_bool.size:
+        table_bool = sparse.csr_matrix(table_bool)
+    return table_bool
+
+
+def _get_recipient_rows(reference_series, metadata, table_index):
     subset_reference_series = \
-        reference_series[reference_series.index.isin(time_metadata.index)]
-    recip_df = table_df[table_df.index.isin(subset_reference_series.index)]
-    return recip_df
-
-
-def _create_masking(time_metadata, donor_df, recip_df, reference_column):
-    donor_index_masking = []
-    for sample in recip_df.index:
-        donor = time_metadata.loc[sample, reference_column]
-        donor_index_masking.append(donor_df.index.get_loc(donor))
-    donor_df = donor_df.to_numpy()
-    donor_mask = donor_df[donor_index_masking]
-    donor_mask = donor_mask.astype(int)
-    recipdf = recip_df.to_numpy()
-    recipdf = recipdf.astype(int)
-    return donor_mask
-
-
-def _mask_recipient(donor_mask, recip_df):
-    maskedrecip = donor_mask & recip_df
-    return maskedrecip
+        reference_series[reference_series.index.isin(metadata.index)]
+    return np.flatnonzero(table_index.isin(subset_reference_series.index))
+
+
+def _count_transferred(donor_matrix, donor_rows, recipmask):
+    if sparse.issparse(donor_matrix):
+        maskedrecip = donor_matrix[donor_rows].multiply(recipmask)
+        return _sum_mask(maskedrecip, axis=1)
+    # Eight features are packed into each byte, so the intersection and its
+    # count only touch an eighth of the memory of the boolean masks
+    packed_donors = np.packbits(donor_matrix, axis=1)[donor_rows]
+    packed_recips = np.packbits(recipmask, axis=1)
+    maskedrecip = np.bitwise_and(packed_donors, packed_recips,
+                                 out=packed_donors)
+    return _count_bits(maskedrecip).sum(axis=1, dtype=np.int64)
+
+
+def _count_bits(packed):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(packed, out=packed)
+    return np.take(_BYTE_BIT_COUNTS, packed, out=packed)
+
+
+def _sum_mask(mask, axis):
+    # sparse matrices reduce to a 2D np.matrix, so flatten back to 1D
+    return np.asarray(mask.sum(axis=axis, dtype=np.int64)).ravel()
+
+
+def _count_feature_peds(donor_matrix, donor_rows, recipmask, time_ids,
+                        n_times):
+    n_donors = donor_matrix.shape[0]
+    # only the (timepoint, donor) pairs that have recipients are built
+    pairs, pair_ids = np.unique(time_ids * n_donors + donor_rows,
+                                return_inverse=True)
+    pair_times = pairs // n_donors
+    pair_donors = donor_matrix[pairs % n_donors]
+    pair_sizes = np.bincount(pair_ids, minlength=len(pairs))
+    if sparse.issparse(recipmask):
+        # Recipients are summed per pair and masked by the pair's donor
+        # without leaving CSR; only the timepoint totals are made dense
+        recip_totals = \
+            _group_indicator(pair_ids, len(pairs)) @ recipmask
+        num_sum = (_group_indicator(pair_times, n_times)
+                   @ recip_totals.multiply(pair_donors))
+        donor_sum = (_group_indicator(pair_times, n_times, pair_sizes)
+                     @ pair_donors)
+        return num_sum.toarray(), donor_sum.toarray()
+    if len(pairs) * 8 <= recipmask.shape[0]:
+        # With few pairs per recipient the int64 pair totals are smaller
+        # than the boolean recipient mask, so recipients are summed per pair
+        # and each pair total is masked by its donor's features
+        recip_totals = _sum_groups(recipmask, pair_ids, len(pairs))
+        num_sum = _sum_groups(recip_totals * pair_donors, pair_times,
+                              n_times)
+        donor_sum = _sum_groups(pair_donors * pair_sizes[:, np.newaxis],
+                                pair_times, n_times)
+        return num_sum, donor_sum
+    # otherwise every recipient is intersected with its own donor row
+    donormask = donor_matrix[donor_rows]
+    maskedrecip = donormask & recipmask
+    return (_sum_groups(maskedrecip, time_ids, n_times),
+            _sum_groups(donormask, time_ids, n_times))
+
+
+def _group_indicator(group_ids, n_groups, weights=None):
+    if weights is None:
+        weights = np.ones(len(group_ids), dtype=np.int64)
+    return sparse.csr_matrix(
+        (weights.astype(np.int64, copy=False),
+         (group_ids, np.arange(len(group_ids)))),
+        shape=(n_groups, len(group_ids)))
+
+
+def _sum_groups(mask, group_ids, n_groups):
+    group_order = np.argsort(group_ids, kind='stable')
+    present_groups, group_starts = np.unique(group_ids[group_order],
+                                             return_index=True)
+    group_sums = np.zeros((n_groups, mask.shape[1]), dtype=np.int64)
+    group_sums[present_groups] = np.add.reduceat(
+        mask[group_order], group_starts, axis=0, dtype=np.int64)
+    return group_sums
@@ -7,7 +7,7 @@
 # ----------------------------------------------------------------------------
 
 import pandas as pd
-import numpy as np
+from scipy import sparse
 from skbio.stats.distance import DistanceMatrix
 
 from qiime2.plugin.testing import TestPluginBase
@@ -19,7 +19,8 @@ from q2_fmt._peds import (_compute_peds, sample_peds,
                           _check_reference_column, _check_for_time_column,
                           _check_subject_column, _check_column_type,
                           _drop_incomplete_timepoints, feature_peds,
-                          _check_column_missing, _rename_features)
+                          _check_column_missing, _rename_features,
+                          _presence_matrix)
 
 
 class TestBase(TestPluginBase):
@@ -643,14 +644,12 @@ class TestPeds(TestBase):
             'Feature1': [1, 0, 1, 1, 1, 1],
             'Feature2': [1, 1, 1, 1, 1, 1],
             'Feature3': [0, 0, 1, 1, 1, 1]}).set_index('id')
-        peds_df = pd.DataFrame(columns=['id', 'measure',
-                                        'transfered_donor_features',
-                                        'total_donor_features', 'donor',
-                                        'subject', 'group'])
-        peds_df = _compute_peds(peds_df=peds_df, peds_type="Sample",
-                                peds_time=np.nan,
+        peds_df = _compute_peds(peds_type="Sample",
                                 reference_series=reference_series,
-                                table=table_df, metadata=metadata_df,
+                                table_bool=_presence_matrix(table_df),
+                                table_index=table_df.index,
+                                table_columns=table_df.columns,
+                                metadata=metadata_df,
                                 time_column="group", reference_column="Ref",
                                 subject_column="subject")
         peds_df = peds_df.set_index("id")
@@ -673,15 +672,12 @@ class TestPeds(TestBase):
                    'donor1', 'donor2'],
             'Feature1': [1, 0, 1, 1, 1, 1],
             'Feature3': [1, 1, 1, 1, 1, 1]}).set_index('id')
-        peds_df = pd.DataFrame(columns=['id', 'measure',
-                                        'transfered_donor_features',
-                                        'total_donor_features', 'donor',
-                                        'subject',
-                                        'group'])
-        peds_df = _compute_peds(peds_df=peds_df, peds_type="Sample",
-                                peds_time=np.nan,
+        peds_df = _compute_peds(peds_type="Sample",
                                 reference_series=reference_series,
-                                table=table_df, metadata=metadata_df,
+                                table_bool=_presence_matrix(table_df),
+                                table_index=table_df.index,
+                                table_columns=table_df.columns,
+                                metadata=metadata_df,
                                 time_column="group", reference_column="Ref",
                                 subject_column="subject")
         peds_df = peds_df.set_index("id")
@@ -705,14 +701,12 @@ class TestPeds(TestBase):
             'Feature1': [1, 0, 1, 1, 1, 1],
             'Feature2': [1, 1, 1, 1, 1, 1],
             'Feature3': [0, 0, 1, 1, 1, 1]}).set_index('id')
-        peds_df = pd.DataFrame(columns=['id', 'measure',
-                                        'transfered_donor_features',
-                                        'total_donor_features', 'donor',
-                                        'subject', 'group'])
-        peds_df = _compute_peds(peds_df=peds_df, peds_type="Sample",
-                                peds_time=np.nan,
+        peds_df = _compute_peds(peds_type="Sample",
                                 reference_series=reference_series,
-                                table=table_df, metadata=metadata_df,
+                                table_bool=_presence_matrix(table_df),
+                                table_index=table_df.index,
+                                table_columns=table_df.columns,
+                                metadata=metadata_df,
                                 time_column="group", reference_column="Ref",
                                 subject_column="subject")
         peds_df = peds_df.set_index("id")
@@ -806,6 +800,71 @@ class TestPeds(TestBase):
             })
         pd.testing.assert_frame_equal(sample_peds_df, exp_peds_df)
 
+    def test_subject_with_sample_without_timepoint(self):
+        metadata_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4', 'sample5',
+                   'donor1'],
+            'Ref': ['donor1', 'donor1', 'donor1', 'donor1', 'donor1',
+                    float("Nan")],
+            'subject': ['sub1', 'sub1', 'sub2', 'sub2', 'sub1',
+                        float("Nan")],
+            'group': [1, 2, 1, 2, float("Nan"),
+                      float("Nan")]}).set_index('id')
+        metadata = Metadata(metadata_df)
+        table_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4', 'sample5',
+                   'donor1'],
+            'Feature1': [1, 1, 0, 1, 1, 1],
+            'Feature2': [0, 1, 1, 1, 1, 1],
+            'Feature3': [0, 0, 1, 1, 1, 1]}).set_index('id')
+        sample_peds_df = sample_peds(table=table_df, metadata=metadata,
+                                     time_column="group",
+                                     reference_column="Ref",
+                                     subject_column="subject")
+        exp_peds_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4'],
+            'measure': [1/3, 2/3, 2/3, 1],
+            'transfered_donor_features': [1, 2, 2, 3],
+            'total_donor_features': [3, 3, 3, 3],
+            'donor': ["donor1", "donor1", "donor1", "donor1"],
+            'subject': ["sub1", "sub1", "sub2", "sub2"],
+            'group': [1.0, 2.0, 1.0, 2.0]
+            })
+        pd.testing.assert_frame_equal(sample_peds_df, exp_peds_df)
+
+    def test_subject_with_sample_without_timepoint_drop_incomplete(self):
+        metadata_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4', 'sample5',
+                   'sample6', 'donor1'],
+            'Ref': ['donor1', 'donor1', 'donor1', 'donor1', 'donor1',
+                    'donor1', float("Nan")],
+            'subject': ['sub1', 'sub1', 'sub2', 'sub2', 'sub1', 'sub3',
+                        float("Nan")],
+            'group': [1, 2, 1, 2, float("Nan"), 1,
+                      float("Nan")]}).set_index('id')
+        metadata = Metadata(metadata_df)
+        table_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4', 'sample5',
+                   'sample6', 'donor1'],
+            'Feature1': [1, 1, 0, 1, 1, 1, 1],
+            'Feature2': [0, 1, 1, 1, 1, 1, 1],
+            'Feature3': [0, 0, 1, 1, 1, 1, 1]}).set_index('id')
+        sample_peds_df = sample_peds(table=table_df, metadata=metadata,
+                                     time_column="group",
+                                     reference_column="Ref",
+                                     subject_column="subject",
+                                     drop_incomplete_subjects=True)
+        exp_peds_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4'],
+            'measure': [1/3, 2/3, 2/3, 1],
+            'transfered_donor_features': [1, 2, 2, 3],
+            'total_donor_features': [3, 3, 3, 3],
+            'donor': ["donor1", "donor1", "donor1", "donor1"],
+            'subject': ["sub1", "sub1", "sub2", "sub2"],
+            'group': [1.0, 2.0, 1.0, 2.0]
+            })
+        pd.testing.assert_frame_equal(sample_peds_df, exp_peds_df)
+
     def test_incorrect_reference_column_name(self):
         metadata_df = pd.DataFrame({
             'id': ['sample1', 'sample2', 'sample3', 'sample4',
@@ -1023,6 +1082,198 @@ class TestPeds(TestBase):
         self.assertEqual(TDFs1, 1/3)
         self.assertEqual(TDFs2, 2/3)
 
+    def test_peds_calc_donor_without_features(self):
+        metadata_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4',
+                   'donor1', 'donor2'],
+            'Ref': ['donor1', 'donor1', 'donor2', 'donor2', float("Nan"),
+                    float("Nan")],
+            'subject': ['sub1', 'sub1', 'sub2', 'sub2', float("Nan"),
+                        float("Nan")],
+            'group': [1, 2, 1, 2, float("Nan"),
+                      float("Nan")]}).set_index('id')
+        metadata = Metadata(metadata_df)
+        table_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4',
+                   'donor1', 'donor2'],
+            'Feature1': [0, 1, 1, 1, 0, 1],
+            'Feature2': [1, 1, 0, 1, 0, 1],
+            'Feature3': [0, 0, 1, 1, 0, 1]}).set_index('id')
+        sample_peds_df = sample_peds(table=table_df, metadata=metadata,
+                                     time_column="group",
+                                     reference_column="Ref",
+                                     subject_column="subject")
+        exp_peds_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4'],
+            'measure': [float("Nan"), float("Nan"), 2/3, 1],
+            'transfered_donor_features': [0, 0, 2, 3],
+            'total_donor_features': [0, 0, 3, 3],
+            'donor': ["donor1", "donor1", "donor2", "donor2"],
+            'subject': ["sub1", "sub1", "sub2", "sub2"],
+            'group': [1.0, 2.0, 1.0, 2.0]
+            })
+        pd.testing.assert_frame_equal(sample_peds_df, exp_peds_df)
+
+    def test_filter_missing_references_removes_subject(self):
+        metadata_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4', 'sample5',
+                   'donor1'],
+            'Ref': ['donor1', 'donor1', float("Nan"), 'donor1', 'donor1',
+                    float("Nan")],
+            'subject': ['sub1', 'sub1', 'sub2', 'sub3', 'sub3',
+                        float("Nan")],
+            'group': [1, 2, 1, 1, 2, float("Nan")]}).set_index('id')
+        metadata = Metadata(metadata_df)
+        table_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4', 'sample5',
+                   'donor1'],
+            'Feature1': [1, 0, 1, 1, 1, 1],
+            'Feature2': [1, 1, 1, 0, 1, 1]}).set_index('id')
+        sample_peds_df = sample_peds(table=table_df, metadata=metadata,
+                                     time_column="group",
+                                     reference_column="Ref",
+                                     subject_column="subject",
+                                     filter_missing_references=True)
+        exp_peds_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample4', 'sample5'],
+            'measure': [1, 0.5, 0.5, 1],
+            'transfered_donor_features': [2, 1, 1, 2],
+            'total_donor_features': [2, 2, 2, 2],
+            'donor': ["donor1", "donor1", "donor1", "donor1"],
+            'subject': ["sub1", "sub1", "sub3", "sub3"],
+            'group': [1.0, 2.0, 1.0, 2.0]
+            })
+        pd.testing.assert_frame_equal(sample_peds_df, exp_peds_df)
+
+    def test_sparse_peds_calc(self):
+        metadata_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4',
+                   'donor1', 'donor2'],
+            'Ref': ['donor1', 'donor1', 'donor1', 'donor2', float("Nan"),
+                    float("Nan")],
+            'subject': ['sub1', 'sub1', 'sub1', 'sub2', float("Nan"),
+                        float("Nan")],
+            'group': [1, 2, 3, 2, float("Nan"),
+                      float("Nan")]}).set_index('id')
+        metadata = Metadata(metadata_df)
+        table_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4',
+                   'donor1', 'donor2'],
+            'Feature1': [0, 0, 1, 1, 1, 1],
+            'Feature2': [0, 1, 1, 1, 1, 1],
+            'Feature3': [0, 0, 1, 1, 1, 1]}).set_index('id')
+        # pad with absent features so the table is handled as sparse
+        absent_df = pd.DataFrame(0, index=table_df.index,
+                                 columns=['Absent%d' % i for i in range(30)])
+        table_df = pd.concat([table_df, absent_df], axis=1)
+        self.assertTrue(sparse.issparse(_presence_matrix(table_df)))
+        sample_peds_df = sample_peds(table=table_df, metadata=metadata,
+                                     time_column="group",
+                                     reference_column="Ref",
+                                     subject_column="subject",
+                                     drop_incomplete_subjects=True)
+        exp_peds_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3'],
+            'measure': [0, 0.333333, 1],
+            'transfered_donor_features': [0, 1, 3],
+            'total_donor_features': [3, 3, 3],
+            'donor': ["donor1", "donor1", "donor1"],
+            'subject': ["sub1", "sub1", "sub1"],
+            'group': [1.0, 2.0, 3.0]
+            })
+        pd.testing.assert_frame_equal(sample_peds_df, exp_peds_df)
+
+    def test_feature_peds_multiple_donors_and_timepoints(self):
+        metadata_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4', 'sample5',
+                   'sample6', 'donor1', 'donor2'],
+            'Ref': ['donor1', 'donor1', 'donor1', 'donor1', 'donor2',
+                    'donor1', float("Nan"), float("Nan")],
+            'subject': ['sub1', 'sub1', 'sub2', 'sub2', 'sub3', 'sub3',
+                        float("Nan"), float("Nan")],
+            'group': [1, 2, 1, 2, 1, 2, float("Nan"),
+                      float("Nan")]}).set_index('id')
+        metadata = Metadata(metadata_df)
+        table_df = pd.DataFrame({
+            'id': ['sample1', 'sample2', 'sample3', 'sample4', 'sample5',
+                   'sample6', 'donor1', 'donor2'],
+            'Feature1': [1, 1, 0, 1, 1, 0, 1, 0],
+            'Feature2': [0, 1, 1, 1, 1, 0, 1, 1],
+            'Feature3': [0, 0, 1, 1, 0, 1, 0, 1],
+            'Feature4': [1, 0, 1, 0, 1, 1, 0, 0]}).set_index('id')
+        # pad with absent features so the table is handled as sparse
+        absent_df = pd.DataFrame(0, index=table_df.index,
+                                 columns=['Absent%d' % i for i in range(40)])
+        sparse_table_df = pd.concat([table_df, absent_df], axis=1)
+        self.assertFalse(sparse.issparse(_presence_matrix(table_df)))
+        self.assertTrue(sparse.issparse(_presence_matrix(sparse_table_df)))
+
+        # Feature3 has no donor at timepoint 2 and Feature4 has no donor
+        # at either timepoint, so neither has a PEDS value there
+        exp_peds_df = pd.DataFrame({
+            'id': ['Feature1', 'Feature2', 'Feature3', 'Feature1',
+                   'Feature2'],
+            'measure': [1/2, 2/3, 0, 2/3, 2/3],
+            'recipients with feature': [1, 2, 0, 2, 2],
+            'all possible recipients with feature': [2, 3, 1, 3, 3],
+            'group': [1.0, 1.0, 1.0, 2.0, 2.0],
+            'subject': ['Feature1', 'Feature2', 'Feature3', 'Feature1',
+                        'Feature2']
+            })
+        for table in (table_df, sparse_table_df):
+            feature_peds_df = feature_peds(table=table, metadata=metadata,
+                                           time_column="group",
+                                           reference_column="Ref",
+                                           subject_column="subject")
+            pd.testing.assert_frame_equal(feature_peds_df, exp_peds_df)
+
+    def test_feature_peds_many_recipients_per_donor(self):
+        # eight copies of each recipient, so the recipients are summed per
+        # (timepoint, donor) pair before being masked by their donor
+        recipients = [('sample1', 'donor1', 'sub1', 1, [1, 0, 0, 1]),
+                      ('sample2', 'donor1', 'sub1', 2, [1, 1, 0, 0]),
+                      ('sample3', 'donor1', 'sub2', 1, [0, 1, 1, 1]),
+                      ('sample4', 'donor1', 'sub2', 2, [1, 1, 1, 0]),
+                      ('sample5', 'donor2', 'sub3', 1, [1, 1, 0, 1]),
+                      ('sample6', 'donor1', 'sub3', 2, [0, 0, 1, 1])]
+        ids = []
+        refs = []
+        subjects = []
+        groups = []
+        features = []
+        for copy in range(8):
+            for sample, ref, subject, group, feature_row in recipients:
+                ids.append('%s_%d' % (sample, copy))
+                refs.append(ref)
+                subjects.append('%s_%d' % (subject, copy))
+                groups.append(group)
+                features.append(feature_row)
+        metadata_df = pd.DataFrame({
+            'id': ids + ['donor1', 'donor2'],
+            'Ref': refs + [float("Nan"), float("Nan")],
+            'subject': subjects + [float("Nan"), float("Nan")],
+            'group': groups + [float("Nan"), float("Nan")]}).set_index('id')
+        metadata = Metadata(metadata_df)
+        table_df = pd.DataFrame(
+            features + [[1, 1, 0, 0], [0, 1, 1, 0]],
+            index=pd.Index(ids + ['donor1', 'donor2'], name='id'),
+            columns=['Feature1', 'Feature2', 'Feature3', 'Feature4'])
+        feature_peds_df = feature_peds(table=table_df, metadata=metadata,
+                                       time_column="group",
+                                       reference_column="Ref",
+                                       subject_column="subject")
+        exp_peds_df = pd.DataFrame({
+            'id': ['Feature1', 'Feature2', 'Feature3', 'Feature1',
+                   'Feature2'],
+            'measure': [1/2, 2/3, 0, 2/3, 2/3],
+            'recipients with feature': [8, 16, 0, 16, 16],
+            'all possible recipients with feature': [16, 24, 8, 24, 24],
+            'group': [1.0, 1.0, 1.0, 2.0, 2.0],
+            'subject': ['Feature1', 'Feature2', 'Feature3', 'Feature1',
+                        'Feature2']
+            })
+        pd.testing.assert_frame_equal(feature_peds_df, exp_peds_df)
+
     def test_sample_id_match(self):
         metadata_df = pd.DataFrame({
             'id': ['sample1', 'sample2', 'sample3', 'sample4',
@@ -1099,15 +1350,13 @@ class TestPeds(TestBase):
             'Feature1': [1, 0, 1, 1, 1, 1],
             'Feature2': [1, 1, 1, 1, 1, 1],
             'Feature3': [0, 0, 1, 1, 1, 1]}).set_index('id')
-        peds_df = pd.DataFrame(columns=['id', 'measure',
-                                        'transfered_donor_features',
-                                        'total_donor_features', 'donor',
-                                        'subject', 'group'])
         with self.assertRaisesRegex(AssertionError, ".*['1' '2'].*"):
-            _compute_peds(peds_df=peds_df, peds_type="Sample",
-                          peds_time=np.nan,
+            _compute_peds(peds_type="Sample",
                           reference_series=reference_series,
-                          table=table_df, metadata=metadata_df,
+                          table_bool=_presence_matrix(table_df),
+                          table_index=table_df.index,
+                          table_columns=table_df.columns,
+                          metadata=metadata_df,
                           time_column="group", reference_column="Ref",
                           subject_column="subject")
 